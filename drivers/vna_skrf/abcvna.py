@@ -3,7 +3,10 @@ This is a model module.  It will not function correctly to pull data, but needs
 to be subclassed.
 """
 import abc
+import warnings
+
 import pyvisa
+from pyvisa import constants
 
 class VNA(abc.ABC):
     """
@@ -51,7 +54,8 @@ class VNA(abc.ABC):
             a visa resource string, or an ip address
         kwargs : dict
             visa_library (str), timemout in milliseconds (int), card_number
-            (int), interface (str)
+            (int), interface (str), chunk_size (int), read_termination (str),
+            write_termination (str)
 
         Notes
         -----
@@ -74,6 +78,14 @@ class VNA(abc.ABC):
             one of "SOCKET", "GPIB"
         card_number : int
             for GPIB, default is usually 0
+        read_termination : str
+            default is a newline, pass carriage return + newline for
+            instruments that terminate socket responses that way
+        write_termination : str
+            default is a newline
+        chunk_size : int
+            bytes per low-level read, default is 1 MiB so that a full trace
+            transfers in one or two reads rather than many small ones
         """
         rm = kwargs.get("resource_manager", None)
         if not rm:
@@ -82,25 +94,25 @@ class VNA(abc.ABC):
         interface = str(kwargs.get("interface", None)).upper()  # GPIB, SOCKET
         if interface == "GPIB":
             board = str(kwargs.get("card_number", "")).upper()
-            resource_string = "GPIB{:}::{:}::INSTR".format(board, address)
+            resource_string = f"GPIB{board}::{address}::INSTR"
         elif interface == "SOCKET":
             port = str(kwargs.get("port", 5025))
-            resource_string = "TCPIP0::{:}::{:}::SOCKET".format(address, port)
+            resource_string = f"TCPIP0::{address}::{port}::SOCKET"
         else:
             resource_string = address
         self.resource = rm.open_resource(resource_string)  # type: pyvisa.resources.messagebased.MessageBasedResource
         self.resource.timeout = kwargs.get("timeout", 3000)
+        self.resource.chunk_size = kwargs.get("chunk_size", 1 << 20)
 
-        self.resource.read_termination = "\n"  # most queries are terminated with a newline
-        self.resource.write_termination = "\n"
-        if "instr" in resource_string.lower():
-            self.resource.control_ren(2)
+        # most queries are terminated with a newline, some instruments use "\r\n" on raw sockets
+        self.resource.read_termination = kwargs.get("read_termination", "\n")
+        self.resource.write_termination = kwargs.get("write_termination", "\n")
 
-        # convenience pyvisa functions
-        self.write = self.resource.write
-        self.read = self.resource.read
-        self.query = self.resource.query
-        self.query_values = self.resource.query_values
+        resource_upper = resource_string.upper()
+        if interface == "GPIB" or resource_upper.startswith("GPIB"):
+            self.resource.control_ren(2)
+        elif resource_upper.endswith("SOCKET"):
+            self.set_tcp_nodelay()
 
     def __enter__(self):
         """
@@ -117,6 +129,42 @@ class VNA(abc.ABC):
     def close(self):
         self.__exit__(None, None, None)
 
+    # convenience pyvisa functions, methods so that subclasses can override them
+    def write(self, *args, **kwargs):
+        return self.resource.write(*args, **kwargs)
+
+    def read(self, *args, **kwargs):
+        return self.resource.read(*args, **kwargs)
+
+    def query(self, *args, **kwargs):
+        return self.resource.query(*args, **kwargs)
+
+    def query_values(self, *args, **kwargs):
+        return self.resource.query_values(*args, **kwargs)
+
+    def set_tcp_nodelay(self, onoff=True):
+        """
+        set TCP_NODELAY (i.e. disable Nagle) on a raw SOCKET connection
+
+        Many small SCPI writes otherwise wait on Nagle + delayed-ack coupling,
+        which costs tens to hundreds of ms per command on some instruments.
+        Both NI-VISA and pyvisa-py honor VI_ATTR_TCPIP_NODELAY.
+        """
+        value = constants.VI_TRUE if onoff else constants.VI_FALSE
+        try:
+            self.resource.set_visa_attribute(constants.VI_ATTR_TCPIP_NODELAY, value)
+        except (pyvisa.VisaIOError, NotImplementedError) as e:
+            warnings.warn(f"unable to set TCP_NODELAY on {self.resource.resource_name}: {e}")
+
+    def clear_io(self):
+        """
+        device clear, flushing the instrument and interface I/O buffers
+
+        Only needed to recover from an error such as a timeout that leaves an
+        unread response behind, so it is not part of the normal query flow.
+        """
+        self.resource.clear()
+
     @property
     def idn(self):
         return self.query("*IDN?")
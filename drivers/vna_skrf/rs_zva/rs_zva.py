@@ -1,3 +1,4 @@
+import re
 import warnings
 from collections import OrderedDict
 
@@ -8,6 +9,77 @@ import pyvisa
 from ..abcvna import VNA
 from . import rs_zva_scpi
 
+scpi_error_code = re.compile(r'(-?\d+),"')  # error codes in a SYST:ERR:ALL? response
+
+
+def _pack_complex(sdata):
+    """
+    convert interleaved real/imag data into a complex array
+
+    contiguous float64 data (the REAL,64 binary format) is reinterpreted as
+    complex128 without copying, anything else (e.g. REAL,32 or a list) is
+    first converted to contiguous float64 in a single pass
+    """
+    return np.ascontiguousarray(sdata, dtype=np.float64).view(np.complex128)
+
+
+def _pack_reshape(sdata, n_params, index):
+    """
+    gather concatenated interleaved traces into an (npoints, nports, nports)
+    S-parameter array
+
+    Parameters
+    ----------
+    sdata : np.ndarray
+        flat real/imag data of n_params traces, back to back
+    n_params : int
+        number of traces in sdata
+    index : np.ndarray
+        (nports, nports) integers, the trace in sdata for each matrix entry
+
+    Returns
+    -------
+    np.ndarray
+        C-ordered complex array, the pack and the transpose are done in a
+        single take into the output
+    """
+    s = _pack_complex(sdata).reshape(n_params, -1)  # shape: (n_params, npoints)
+    npoints = s.shape[1]
+    nports = index.shape[0]
+    out = np.empty(shape=(npoints, nports, nports), dtype=complex)
+    np.take(s.T, index.ravel(), axis=1, out=out.reshape(npoints, nports * nports))
+    return out
+
+
+class _SCPI(rs_zva_scpi.SCPI):
+    """
+    the generated ZVA SCPI commands, with a faster parser for ascii data
+
+    pyvisa's ascii converter splits the response and calls float() per token
+    in python; with ascii_data set, query_values reads the raw block and
+    parses it in C with np.fromstring instead
+    """
+    def __init__(self, resource):
+        super(_SCPI, self).__init__(resource)
+        self.ascii_data = False
+
+    def query_values(self, scpi, *args, **kwargs):
+        if not self.ascii_data:
+            return super(_SCPI, self).query_values(scpi, *args, **kwargs)
+        if args or kwargs:
+            raise TypeError("query_values takes no extra arguments in ascii mode")
+        if self.echo:
+            print(scpi)
+        self.resource.write(scpi)
+        response = self.resource.read_raw().decode("ascii").strip()
+        # np.fromstring parses a trailing separator as an extra -1.0 instead of failing
+        if not response or response.endswith(","):
+            raise ValueError(f"malformed ascii data block: {response[-40:]!r}")
+        values = np.fromstring(response, dtype=np.float64, sep=",")
+        if len(values) % 2:
+            raise ValueError(f"expected interleaved real/imag data, got {len(values)} values")
+        return values
+
 
 class ZVA(VNA):
     """
@@ -28,23 +100,39 @@ class ZVA(VNA):
             visa resource string (full string or ip address)
         kwargs : dict
             interface (str), port (int), timeout (int),
+            data_format (str -> binary, ascii)
         """
+        # validate before the resource is opened so that it is not leaked
+        data_format = kwargs.get("data_format", "binary").lower()
+        if data_format not in ("binary", "ascii"):
+            raise ValueError(f"data_format must be one of 'binary', 'ascii', not: {data_format}")
+
         super(ZVA, self).__init__(address, **kwargs)
         self.resource.timeout = kwargs.get("timeout", 2000)
-        self.scpi = rs_zva_scpi.SCPI(self.resource)
-        self.use_ascii()  # less likely to cause problems than use_binary
+        self.scpi = _SCPI(self.resource)
+        self._data_call_supported = True  # cleared if CALC:DATA:CALL? is not supported
+
+        if data_format == "binary":
+            self.use_binary()
+        else:
+            self.use_ascii()
 
     def use_binary(self):
         """setup the analyzer to transfer in binary which is faster, especially
         for large datasets"""
         self.scpi.set_format_binary(ORDER='SWAP')
         self.scpi.set_format_data(DATA='REAL,64')
+        self.scpi.ascii_data = False
         self.resource.values_format.use_binary(datatype='d',
                                                is_big_endian=False,
                                                container=np.array)
 
     def use_ascii(self):
+        """setup the analyzer to transfer in ascii, slower but less likely to
+        cause problems with some interfaces"""
         self.scpi.set_format_data(DATA='ASCII')
+        self.scpi.ascii_data = True
+        # self.scpi parses ascii itself, this still serves VNA.query_values
         self.resource.values_format.use_ascii(converter='f', separator=',',
                                               container=np.array)
 
@@ -69,6 +157,7 @@ class ZVA(VNA):
             channel = self.scpi.query_active_channel()
         except pyvisa.VisaIOError:
             print("No channel active, using 1")
+            self.clear_io()
             channel = 1
         finally:
             self.resource.timeout = old_timeout
@@ -85,26 +174,51 @@ class ZVA(VNA):
 
         Notes
         -----
+        see set_active_channel, which also allows verifying the change
+        """
+        self.set_active_channel(channel)
+
+    def set_active_channel(self, channel, verify=False):
+        """
+        Set the active channel on the analyzer
+
+        Parameters
+        ----------
+        channel : int
+        verify : bool
+            read the active channel back from the analyzer in the same
+            compound command, costs a read
+
+        Returns
+        -------
+        int
+            the active channel
         """
         old_timeout = self.resource.timeout
         self.resource.timeout = 500
-        if channel in self.channel_list:
+        try:
+            if channel not in self.channel_list:
+                print(f"Channel {channel:d} not in list of channels. Create channel first")
+                return self.scpi.query_active_channel()
+            if verify:
+                return int(self.scpi.query(f":INST:NSEL {channel};:INST:NSEL?"))
             self.scpi.set_active_channel(channel)
-        else:
-            print('Channel %i not in list of channels. Create channel first'
-                  % channel)
-        set_channel = self.scpi.query_active_channel()
-        self.resource.timeout = old_timeout
-        return set_channel
+            return channel
+        finally:
+            self.resource.timeout = old_timeout
+
+    def _get_channel(self, kwargs):
+        """the channel from kwargs, only querying the active channel if it was not given"""
+        channel = kwargs.get("channel", None)
+        if channel is None:
+            channel = self.active_channel
+        return channel
 
     @property
     def channel_list(self):
         """Return list of channels"""
-        return_str = self.scpi.query_channel_catalog().split(',')
-        channel_dct = {}
-        for i in range(int(len(return_str)/2)):
-            channel_dct[int(return_str[2 * i])] = return_str[2 * i + 1]
-        return channel_dct
+        it = iter(self.scpi.query_channel_catalog().split(','))
+        return {int(number): name for number, name in zip(it, it)}
 
     def get_frequency(self, **kwargs):
         """
@@ -120,11 +234,8 @@ class ZVA(VNA):
         skrf.Frequency
         """
         #self.resource.clear()
-        channel = kwargs.get("channel", self.active_channel)
-        use_log = "LOG" in self.scpi.query_sweep_type(channel).upper()
-        f_start = self.scpi.query_f_start(channel)
-        f_stop = self.scpi.query_f_stop(channel)
-        f_npoints = self.scpi.query_sweep_n_points(channel)
+        channel = self._get_channel(kwargs)
+        use_log, f_start, f_stop, f_npoints = self.query_sweep(channel)
         if use_log:
             freq = np.logspace(np.log10(f_start), np.log10(f_stop), f_npoints)
         else:
@@ -134,25 +245,50 @@ class ZVA(VNA):
         frequency.unit = kwargs.get("f_unit", "Hz")
         return frequency
 
+    def query_sweep(self, channel):
+        """
+        query the sweep type, start, stop and number of points of a channel
+
+        The four queries are chained into a single compound command so that
+        they cost one round trip instead of four.
+
+        Returns
+        -------
+        tuple
+            (use_log (bool), f_start (float), f_stop (float), f_npoints (int))
+        """
+        scpi_command = f":SENS{channel}:SWE:TYPE?;:SENS{channel}:FREQ:STAR?;" \
+                       f":SENS{channel}:FREQ:STOP?;:SENS{channel}:SWE:POIN?"
+        sweep_type, f_start, f_stop, f_npoints = self.scpi.query(scpi_command).split(";")
+        return "LOG" in sweep_type.upper(), float(f_start), float(f_stop), int(f_npoints)
+
+    def set_sweep(self, channel, f_start, f_stop, f_npoints):
+        """
+        set the start, stop (Hz) and number of points of a channel with a
+        single compound command, the counterpart of query_sweep
+        """
+        scpi_command = f":SENS{channel}:FREQ:STAR {f_start};:SENS{channel}:FREQ:STOP {f_stop};" \
+                       f":SENS{channel}:SWE:POIN {f_npoints}"
+        self.scpi.write(scpi_command)
+
     def set_frequency_sweep(self, f_start, f_stop, f_npoints, **kwargs):
         f_unit = kwargs.get("f_unit", "hz").lower()
         if f_unit != "hz":
-            f_start = f_start * skrf.Frequency.multiplier_dict[f_unit.lower()]
-            f_stop = f_stop * skrf.Frequency.multiplier_dict[f_unit.lower()]
-        channel = kwargs.get("channel", self.active_channel)
-        self.scpi.set_f_start(channel, f_start)
-        self.scpi.set_f_stop(channel, f_stop)
-        self.scpi.set_sweep_n_points(channel, f_npoints)
+            multiplier = skrf.Frequency.multiplier_dict[f_unit]
+            f_start = f_start * multiplier
+            f_stop = f_stop * multiplier
+        channel = self._get_channel(kwargs)
+        self.set_sweep(channel, f_start, f_stop, f_npoints)
 
     def get_active_trace_as_network(self, **kwargs):
         """get the current trace as a 1-port network object"""
         channel = self.active_channel
         f_unit = kwargs.get("f_unit", "GHz")
         ntwk = skrf.Network()
-        ntwk.name = kwargs.get("name", self.scpi.query_par_select(channel))
+        ntwk.name = kwargs.get("name", None) or self.scpi.query_par_select(channel)
         ntwk.frequency = self.get_frequency(channel=channel, f_unit=f_unit)
         sdata = self.scpi.query_data(channel, "SDATA")
-        ntwk.s = sdata[::2] + 1j * sdata[1::2]
+        ntwk.s = _pack_complex(sdata)
         return ntwk
 
     def get_snp_network(self, ports, **kwargs):
@@ -160,41 +296,42 @@ class ZVA(VNA):
             warnings.warn("Sweep function not yet implemented for ZVA")
 
         # ensure all ports are ints, unique and in a valid range
-        for i, port in enumerate(ports):
-            if type(port) is not int:
-                raise TypeError("ports must be an iterable of integers, not type: {:d}".format(type(port)))
-            if not 0 < port <= self.NPORTS:
-                raise ValueError("invalid ports, must be between 1 and {:d}".format(self.NPORTS))
-            if port in ports[i+1:]:
-                raise ValueError("duplicate port: {:d}".format(port))
-
-        channel = kwargs.get("channel", self.active_channel)
+        ports = tuple(ports)
+        if not all(type(port) is int for port in ports):  # exact type, rejects bool
+            raise TypeError(f"ports must be an iterable of integers, not: {ports}")
+        if not all(0 < port <= self.NPORTS for port in ports):
+            raise ValueError(f"invalid ports, must be between 1 and {self.NPORTS:d}")
+        if len(set(ports)) != len(ports):
+            raise ValueError(f"duplicate port in: {ports}")
+
+        channel = self._get_channel(kwargs)
         catalogue = self.scpi.query_par_catalog(channel)  # type: list
         trace_name = catalogue[::2]
         trace_data = catalogue[1::2]
 
-        port_keys = list()
-        for receive_port in ports:
-            for source_port in ports:
-                key = "S{:d}{:d}".format(receive_port, source_port)
+        # port_keys[m][n] is the parameter for source ports[m], receive ports[n]
+        port_keys = [[f"S{receive_port}{source_port}" for receive_port in ports] for source_port in ports]
+        for keys in port_keys:
+            for key in keys:
                 if key not in trace_data:
-                    raise Exception("missing measurement trace for {:s}".format(key))
-                port_keys.append(key)
+                    raise Exception(f"missing measurement trace for {key}")
 
         nports = len(ports)
-        npoints = self.scpi.query_sweep_n_points(channel)
         ntwk = skrf.Network()
         f_unit = kwargs.get("f_unit", "GHz")
         ntwk.frequency = self.get_frequency(channel=channel, f_unit=f_unit)
-        ntwk.s = np.zeros(shape=(npoints, nports, nports), dtype=complex)
-
-        for m, source_port in enumerate(ports):
-            for n, receive_port in enumerate(ports):
-                port_key = "S{:d}{:d}".format(receive_port, source_port)
-                trace = trace_name[trace_data.index(port_key)]
-                self.scpi.set_par_select(channel, trace)
-                sdata = self.scpi.query_data(channel, "SDATA")
-                ntwk.s[:, m, n] = sdata[::2] + 1j * sdata[1::2]
+        npoints = ntwk.frequency.npoints
+
+        s = self._query_sdata_call(channel, port_keys)
+        if s is None:  # CALC:DATA:CALL? not available, read the traces one by one
+            s = np.empty(shape=(npoints, nports, nports), dtype=complex)
+            for m, keys in enumerate(port_keys):
+                for n, port_key in enumerate(keys):
+                    trace = trace_name[trace_data.index(port_key)]
+                    self.scpi.set_par_select(channel, trace)
+                    sdata = self.scpi.query_data(channel, "SDATA")
+                    s[:, m, n] = _pack_complex(sdata)
+        ntwk.s = s
 
         name = kwargs.get("name", None)
         if not name:
@@ -203,15 +340,76 @@ class ZVA(VNA):
         ntwk.name = name
         return ntwk
 
+    def _query_sdata_call(self, channel, port_keys):
+        """
+        read the S-parameters named by the 2D port_keys in a single transfer
+
+        CALC:DATA:CALL? returns the S-parameter data of the channel
+        concatenated in the order given by CALC:DATA:CALL:CAT?, which replaces
+        a select + query round trip per S-parameter with one query.  Returns
+        None so the caller can fall back to reading trace by trace if:
+        * any requested S-parameter is not part of the catalogue
+        * the catalogue holds S-parameters that were not requested, since
+          transferring them would cost more than the round trips saved
+        * the query fails; if the analyzer reports a command error the
+          firmware lacks the command and it is not tried again
+        """
+        if not self._data_call_supported:
+            return None
+        try:
+            call_keys = [key.strip().upper() for key in self.scpi.query_data_call_catalog(channel)]
+            try:
+                index = np.array([[call_keys.index(key) for key in keys] for keys in port_keys])
+            except ValueError:
+                return None
+            if index.size != len(call_keys):
+                return None
+            sdata = self.scpi.query_data_call(channel, "SDATA")
+        except pyvisa.VisaIOError:
+            self.clear_io()
+            if self._command_error():
+                self._data_call_supported = False
+            return None
+        return _pack_reshape(sdata, len(call_keys), index)
+
+    def _command_error(self):
+        """
+        read and empty the error queue, True if it holds a SCPI command error
+        (-100 to -199, e.g. -113 undefined header)
+        """
+        try:
+            errors = self.scpi.query_system_error_all()
+        except pyvisa.VisaIOError:
+            self.clear_io()
+            return False
+        return any(-199 <= int(code) <= -100 for code in scpi_error_code.findall(errors))
+
     def get_list_of_traces(self, **kwargs):
-        self.resource.clear()
+        """
+        a catalogue of the available data traces
+
+        Parameters
+        ----------
+        kwargs : dict
+            force_clear (bool) - device clear before querying, to recover
+            from a previous I/O error
+
+        Returns
+        -------
+        list
+            list of dicts with the trace name, channel, measurement number,
+            parameter and label, as accepted by self.get_traces
+        """
+        if kwargs.get("force_clear", False):
+            self.clear_io()
         traces = []
         channels = self.scpi.query_available_channels()
         for channel in channels:
             meas_list = self.scpi.query_meas_name_list(channel)
             if len(meas_list) == 1:
                 continue  # if there isnt a single comma, then there aren't any measurments
-            parameters = dict([(meas_list[k], meas_list[k + 1]) for k in range(0, len(meas_list) - 1, 2)])
+            it = iter(meas_list)
+            parameters = dict(zip(it, it))
 
             meas_numbers = self.scpi.query_meas_number_list()
             for mnum in meas_numbers:
@@ -224,10 +422,29 @@ class ZVA(VNA):
         return traces
 
     def get_switch_terms(self, ports=(1, 2), **kwargs):
-        self.resource.clear()
+        """
+        create new traces for the switch terms and return them as a 2-length
+        list of forward and reverse terms
+
+        Parameters
+        ----------
+        ports : Iterable
+            a 2-length iterable of integers specifying the ports
+        kwargs : dict
+            channel (int), force_clear (bool) - device clear before
+            measuring, to recover from a previous I/O error
+
+        Returns
+        -------
+        list
+            a 2-length list of 1-port networks [forward_switch_terms,
+            reverse_switch_terms]
+        """
+        if kwargs.get("force_clear", False):
+            self.clear_io()
         p1, p2 = ports
 
-        self.active_channel = channel = kwargs.get("channel", self.active_channel)
+        self.active_channel = channel = self._get_channel(kwargs)
 
         measurements = self.get_meas_list()
         max_trace = len(measurements)
@@ -265,7 +482,7 @@ class ZVA(VNA):
         traces : list
             list of type that is exported by self.get_list_of_traces
         kwargs : dict
-            sweep (bool), name_prefix (str)
+            sweep (bool), name_prefix (str), force_clear (bool)
 
         Returns
         -------
@@ -276,7 +493,8 @@ class ZVA(VNA):
         -----
         There is no current way to distinguish between traces and 1-port networks within skrf
         """
-        self.resource.clear()
+        if kwargs.get("force_clear", False):
+            self.clear_io()
         sweep = kwargs.get("sweep", False)
 
         name_prefix = kwargs.get("name_prefix", "")
@@ -297,11 +515,11 @@ class ZVA(VNA):
 
         traces = []
         for ch, ch_data in channels.items():
-            frequency = ch_data["frequency"] = self.get_frequency()
+            frequency = ch_data["frequency"] = self.get_frequency(channel=ch)
             for trace in ch_data["traces"]:
-                self.scpi.set_selected_meas_by_number(trace["channel"], trace["measurement number"])
-                sdata = self.scpi.query_data(trace["channel"], "SDATA")
-                s = sdata[::2] + 1j * sdata[1::2]
+                # select and read in one compound command, 1 round trip per trace instead of 2
+                sdata = self.scpi.query_values(f":CALC{ch}:PAR:SEL '{trace['name']}';:CALC{ch}:DATA? SDATA")
+                s = _pack_complex(sdata)
                 ntwk = skrf.Network()
                 ntwk.s = s
                 ntwk.frequency = frequency
@@ -326,8 +544,9 @@ class ZVA(VNA):
         Return a list of measurement names on all channels.
         If channel is provided to kwargs, then only measurements for that channel are queried
         """
-        channel = kwargs.get("channel", self.active_channel)
+        channel = self._get_channel(kwargs)
         meas_list = self.scpi.query_meas_name_list(channel)
         if len(meas_list) == 1:
             return None  # if there isnt a single comma, then there arent any measurments
-        return [(meas_list[k], meas_list[k + 1]) for k in range(0, len(meas_list) - 1, 2)]
+        it = iter(meas_list)
+        return list(zip(it, it))